@@ -74,7 +74,7 @@ def run_evaluation():
     print("-" * 30)
     
     try:
-        from query_engine import SECFinancialQA
+        from query_engine import SECFinancialQA, run_full_evaluation
         
         print("Initializing QA system...")
         qa = SECFinancialQA()
@@ -86,9 +86,8 @@ def run_evaluation():
         result = qa.answer(test_query)
         print(f"Test passed - Confidence: {result.confidence:.1%}")
         
-        # TODO: Run full evaluation suite
         print("\nRunning evaluation...")
-        os.system("python src/query_engine.py")
+        run_full_evaluation(qa, use_async=os.getenv("SEC_QA_ASYNC", "0") == "1")
         
         return True
         
@@ -2,18 +2,25 @@
 import sys
 import os
 import re
-import json
-import time
 import shutil
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from sec_edgar_downloader import Downloader
+import orjson
+import requests_cache
+from sec_edgar_downloader import Downloader, _sec_gateway
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from config.config import RAW_DATA_DIR, COMPANIES
+from config.config import RAW_DATA_DIR, CACHE_DIR, COMPANIES, MAX_WORKERS
 
 FILING_TYPES = ["10-K", "10-Q", "8-K", "DEF 14A", "3", "4", "5"]
 
+FILE_EXTENSIONS = ('.html', '.xml', '.htm')
+
+# Organized files are named "<accession>_<document>", so the match is anchored at the start
+ACCESSION_PATTERN = re.compile(r'(\d{10})-(\d{2})-(\d{6})')
+
 FILING_LIMITS = {
     "10-K": 8, "10-Q": 16, "8-K": 20, 
     "DEF 14A": 6, "3": 8, "4": 20, "5": 6
@@ -28,6 +35,8 @@ DATE_RANGES = {
     "default": "2020-01-01"
 }
 
+SEC_HTTP_CACHE_TTL = 86400  # seconds
+
 class SECDownloader:
     def __init__(self, data_dir=None):
         self.base_path = Path(data_dir) if data_dir else RAW_DATA_DIR
@@ -35,20 +44,51 @@ class SECDownloader:
         self.base_path.mkdir(parents=True, exist_ok=True)
         self.temp_path.mkdir(parents=True, exist_ok=True)
         
+        # Enabled first, since Downloader fetches the SEC ticker mapping as soon as it is created
+        if os.getenv("SEC_ENABLE_HTTP_CACHE", "1") == "1":
+            self.enable_http_cache()
         user_agent = os.getenv("SEC_USER_AGENT", "research@example.com")
         self.downloader = Downloader("SECFinancialQA", user_agent, str(self.temp_path))
-        self.accession_pattern = re.compile(r'(\d{10})-(\d{2})-(\d{6})')
         print(f"SEC Downloader initialized. Data: {self.base_path}")
 
-    def extract_metadata(self, file_path, ticker, filing_type):
-        match = self.accession_pattern.search(file_path.name)
+    def enable_http_cache(self):
+        """Serve repeated SEC requests from local SQLite, without waiting on the rate limiter"""
+        # This patches private sec-edgar-downloader 5.x internals (hence the pin in requirements.txt):
+        # every request goes through _sec_gateway._call_sec, which calls the module-level requests.get
+        # and is wrapped in the library's 10 requests/second limiter
+        if not (callable(getattr(_sec_gateway, "_call_sec", None)) and hasattr(_sec_gateway, "requests")):
+            print("SEC HTTP cache unavailable: unsupported sec-edgar-downloader version")
+            return
+        
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        session = requests_cache.CachedSession(
+            str(CACHE_DIR / "sec_http_cache"), backend="sqlite", expire_after=SEC_HTTP_CACHE_TTL,
+            allowable_methods=("GET",), stale_if_error=True
+        )
+        # A second downloader re-wraps the library's limited call, not the previous wrapper
+        limited_call_sec = getattr(_sec_gateway._call_sec, "_limited_call_sec", _sec_gateway._call_sec)
+        
+        def call_sec(uri, user_agent, host):
+            # Fresh cache hits skip the limiter; misses and expired entries take a token and refill the cache
+            cached = session.get(uri, only_if_cached=True)
+            if cached.status_code == 200 and not cached.is_expired:
+                return cached
+            return limited_call_sec(uri, user_agent, host)
+        
+        call_sec._limited_call_sec = limited_call_sec
+        _sec_gateway.requests = session
+        _sec_gateway._call_sec = call_sec
+        print(f"SEC HTTP cache enabled: {CACHE_DIR}")
+
+    def extract_metadata(self, file_path, ticker, filing_type, stats=None):
+        match = ACCESSION_PATTERN.match(file_path.name)
         if match:
             year_int = int(match.groups()[1])
             filing_year = (1900 if year_int >= 90 else 2000) + year_int
         else:
             filing_year = None
             
-        stats = file_path.stat()
+        stats = stats or file_path.stat()
         return {
             'ticker': ticker, 
             'company_name': COMPANIES.get(ticker, ticker),
@@ -70,82 +110,87 @@ class SECDownloader:
         target_path.mkdir(exist_ok=True)
         total_moved, all_metadata = 0, []
         
-        for filing_type in source_path.iterdir():
-            if not filing_type.is_dir():
-                continue
-                
+        with os.scandir(source_path) as entries:
+            filing_types = [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+        
+        for filing_type in filing_types:
             target_filing_path = target_path / filing_type.name
             target_filing_path.mkdir(exist_ok=True)
             
             limit = FILING_LIMITS.get(filing_type.name, 10)
             files_moved = 0
             
-            for accession_dir in sorted(filing_type.iterdir(), reverse=True):
-                if not accession_dir.is_dir() or files_moved >= limit:
-                    continue
+            with os.scandir(filing_type.path) as entries:
+                accession_dirs = sorted((entry for entry in entries if entry.is_dir(follow_symlinks=False)),
+                                        key=lambda entry: entry.name, reverse=True)
+            
+            for accession_dir in accession_dirs:
+                if files_moved >= limit:
+                    break
                     
-                for file_path in accession_dir.iterdir():
-                    if (file_path.suffix.lower() in ['.html', '.xml', '.htm'] and 
-                        files_moved < limit and file_path.stat().st_size > 500):
+                with os.scandir(accession_dir.path) as entries:
+                    for entry in entries:
+                        if files_moved >= limit:
+                            break
+                        if not entry.name.lower().endswith(FILE_EXTENSIONS):
+                            continue
                         
-                        target_file = target_filing_path / f"{accession_dir.name}_{file_path.name}"
+                        stats = entry.stat(follow_symlinks=False)
+                        if stats.st_size <= 500:
+                            continue
+                        
+                        target_file = target_filing_path / f"{accession_dir.name}_{entry.name}"
                         try:
-                            shutil.move(str(file_path), str(target_file))
-                            all_metadata.append(self.extract_metadata(target_file, ticker, filing_type.name))
+                            # temp_path lives under base_path, so this is a same-filesystem rename
+                            os.replace(entry.path, target_file)
+                            all_metadata.append(self.extract_metadata(target_file, ticker, filing_type.name, stats))
                             total_moved += 1
                             files_moved += 1
                         except Exception as e:
-                            print(f"Error moving {file_path.name}: {e}")
+                            print(f"Error moving {entry.name}: {e}")
                             
-        json.dump(all_metadata, open(target_path / 'filing_metadata.json', 'w'), indent=2, default=str)
+        (target_path / 'filing_metadata.json').write_bytes(orjson.dumps(all_metadata, option=orjson.OPT_INDENT_2, default=str))
         summary = self.create_summary(all_metadata, ticker)
-        json.dump(summary, open(target_path / 'filing_summary.json', 'w'), indent=2)
+        (target_path / 'filing_summary.json').write_bytes(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
         
         return total_moved, all_metadata
 
     def create_summary(self, metadata_list, ticker):
-        summary = {
+        total_size = sum(meta['file_size'] for meta in metadata_list)
+        return {
             'ticker': ticker, 'company_name': COMPANIES.get(ticker, ticker),
-            'total_files': len(metadata_list), 'filing_types': {}, 'years_covered': set(), 'total_size': 0
+            'total_files': len(metadata_list),
+            'filing_types': dict(Counter(meta['filing_type'] for meta in metadata_list)),
+            'years_covered': sorted({meta['estimated_year'] for meta in metadata_list if meta['estimated_year']}),
+            'total_size': total_size,
+            'size_mb': round(total_size / (1024 * 1024), 2)
         }
-        
-        for meta in metadata_list:
-            filing_type = meta['filing_type']
-            summary['filing_types'][filing_type] = summary['filing_types'].get(filing_type, 0) + 1
-            if meta['estimated_year']:
-                summary['years_covered'].add(meta['estimated_year'])
-            summary['total_size'] += meta['file_size']
+
+    def fetch_filing_type(self, ticker, filing_type):
+        try:
+            after_date = DATE_RANGES.get(filing_type, DATE_RANGES["default"])
+            limit = FILING_LIMITS.get(filing_type, 10)
             
-        summary['years_covered'] = sorted(list(summary['years_covered']))
-        summary['size_mb'] = round(summary['total_size'] / (1024 * 1024), 2)
-        return summary
+            # sec-edgar-downloader already throttles every HTTP request it makes to the SEC's
+            # 10 requests/second limit, and that limiter is shared by all threads
+            self.downloader.get(filing_type, ticker, download_details=True, after=after_date, limit=limit)
+            print(f"  {ticker} {filing_type} (limit: {limit})")
+        except Exception as e:
+            print(f"  {ticker} {filing_type}: {e}")
+
+    def submit_downloads(self, executor, ticker):
+        return [executor.submit(self.fetch_filing_type, ticker, filing_type) for filing_type in FILING_TYPES]
 
-    def download_filings(self, ticker):
+    def download_filings(self, ticker, executor=None):
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                return self.download_filings(ticker, executor)
+        
         print(f"Downloading {ticker}")
-        for filing_type in FILING_TYPES:
-            try:
-                after_date = DATE_RANGES.get(filing_type, DATE_RANGES["default"])
-                limit = FILING_LIMITS.get(filing_type, 10)
-                
-                self.downloader.get(filing_type, ticker, download_details=True, after=after_date, limit=limit)
-                print(f"  {filing_type} (limit: {limit})")
-                time.sleep(0.2)
-            except Exception as e:
-                print(f"  {filing_type}: {e}")
-                
+        for future in self.submit_downloads(executor, ticker):
+            future.result()
         return self.organize_files(ticker)
 
-    def get_stats(self, ticker):
-        ticker_path = self.base_path / ticker
-        stats = {}
-        for filing_type in FILING_TYPES:
-            form_path = ticker_path / filing_type
-            if form_path.exists():
-                files = list(form_path.glob("*.html")) + list(form_path.glob("*.xml"))
-                total_size = sum(f.stat().st_size for f in files)
-                stats[filing_type] = {'count': len(files), 'size_mb': total_size / (1024 * 1024)}
-        return stats
-
     def run(self, companies=None):
         start_time = datetime.now()
         companies_to_process = companies or list(COMPANIES.keys())
@@ -153,25 +198,33 @@ class SECDownloader:
         
         print(f"Processing {len(companies_to_process)} companies with limits: {FILING_LIMITS}")
         
-        for i, ticker in enumerate(companies_to_process, 1):
-            print(f"\n[{i}/{len(companies_to_process)}] {ticker} ({COMPANIES.get(ticker, 'Unknown')})")
-            try:
-                files_moved, metadata = self.download_filings(ticker)
-                stats = self.get_stats(ticker)
-                
-                for filing_type, stat in stats.items():
-                    if stat['count'] > 0:
-                        print(f"  {filing_type}: {stat['count']} files ({stat['size_mb']:.1f} MB)")
-                        
-                total_files += files_moved
-                all_metadata.extend(metadata)
-                print(f"  Total: {files_moved} files")
-                
-            except Exception as e:
-                print(f"   Error: {e}")
-            time.sleep(1.0)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            pending = {ticker: self.submit_downloads(executor, ticker) for ticker in companies_to_process}
+            
+            # Organize each ticker as soon as its downloads finish, while later tickers keep downloading
+            for i, ticker in enumerate(companies_to_process, 1):
+                try:
+                    for future in pending[ticker]:
+                        future.result()
+                    print(f"\n[{i}/{len(companies_to_process)}] {ticker} ({COMPANIES.get(ticker, 'Unknown')})")
+                    files_moved, metadata = self.organize_files(ticker)
+                    
+                    # organize_files already recorded every moved file, so no need to rescan the disk
+                    counts, sizes = Counter(), defaultdict(int)
+                    for meta in metadata:
+                        counts[meta['filing_type']] += 1
+                        sizes[meta['filing_type']] += meta['file_size']
+                    for filing_type, count in counts.items():
+                        print(f"  {filing_type}: {count} files ({sizes[filing_type] / (1024 * 1024):.1f} MB)")
+                            
+                    total_files += files_moved
+                    all_metadata.extend(metadata)
+                    print(f"  Total: {files_moved} files")
+                    
+                except Exception as e:
+                    print(f"   Error: {e}")
             
-        json.dump(all_metadata, open(self.base_path / 'master_metadata.json', 'w'), indent=2, default=str)
+        (self.base_path / 'master_metadata.json').write_bytes(orjson.dumps(all_metadata, option=orjson.OPT_INDENT_2, default=str))
         if self.temp_path.exists():
             shutil.rmtree(self.temp_path)
             
@@ -188,7 +241,7 @@ class SECDownloader:
         for ticker in companies:
             summary_file = self.base_path / ticker / 'filing_summary.json'
             if summary_file.exists():
-                summary = json.load(open(summary_file))
+                summary = orjson.loads(summary_file.read_bytes())
                 print(f"{ticker}: {summary['total_files']} files ({summary['size_mb']} MB)")
                 total_files += summary['total_files']
                 total_size += summary['total_size']
@@ -1,10 +1,20 @@
 
-import json
-import pickle
+import ijson
+import orjson
 import numpy as np
 import faiss
+import torch
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 import sys
 import os
+import functools
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List
 from sentence_transformers import SentenceTransformer
@@ -15,6 +25,28 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.config import PROCESSED_DATA_DIR, COMPANIES
 from financial_taxonomy import FinancialTaxonomy
 
+# HNSW graph parameters for the inner-product index
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH_FACTOR = 5
+# Vectors are converted back to float32 this many at a time when added to FAISS
+INDEX_ADD_BATCH = 16384
+
+QUERY_CACHE_SIZE = 1024
+# Concurrent queries are encoded together: flush at this size or after this many seconds
+QUERY_BATCH_SIZE = 32
+QUERY_BATCH_WAIT = 0.005
+
+CPU_BATCH_SIZE = 64
+GPU_BATCH_SIZE = 256
+# Chunk texts are built and encoded this many at a time to bound peak memory
+EMBED_CHUNK_SIZE = 1024
+# Chunk text used in LLM prompts is cut to this many characters
+PROMPT_CONTENT_CHARS = 600
+
+# Chunk concepts are packed into one uint64 bitmask per chunk
+CONCEPT_MASK_BITS = 64
+
 @dataclass
 class SearchResult:
     content: str
@@ -25,24 +57,69 @@ class SearchResult:
     financial_concepts: List[str]
     similarity_score: float
     final_score: float
+    content_prompt: str
+
+@dataclass
+class SearchResultsBatch:
+    """Ranked results alongside column arrays of the fields scoring reads"""
+    results: List[SearchResult]
+    scores: np.ndarray
+    tickers: np.ndarray
+    filing_types: np.ndarray
+    sections: np.ndarray
+    concepts: List[frozenset]
+
+class ChunkTable:
+    """Read-only row view over the memory-mapped chunk metadata table"""
+    
+    def __init__(self, table: pa.Table):
+        self.table = table
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def __getitem__(self, i: int) -> Dict:
+        return self.table.slice(int(i), 1).to_pylist()[0]
+
+    def __iter__(self):
+        for batch in self.table.to_batches():
+            yield from batch.to_pylist()
 
 class EmbeddingEngine:
     def __init__(self, model_name="all-MiniLM-L6-v2"):
         self.processed_data_dir = PROCESSED_DATA_DIR
         self.taxonomy = FinancialTaxonomy()
         
-        print(f"Loading model: {model_name}")
-        self.model = SentenceTransformer(model_name)
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        print(f"Loading model: {model_name} ({self.device})")
+        self.model = SentenceTransformer(model_name, device=self.device)
+        if self.device == "cuda":
+            self.model.half()
         self.dim = self.model.get_sentence_embedding_dimension()
         
         self.chunks_data = []
+        self.embeddings = None
         self.index = None
         
+        # Columnar chunk metadata used to score FAISS candidates in one pass
+        self.ticker_ids = None
+        self.filing_type_ids = None
+        self.section_ids = None
+        self.concept_masks = None
+        
+        self._encode_queue = queue.Queue()
+        self._encode_thread = threading.Thread(target=self._encode_worker, daemon=True)
+        self._encode_thread.start()
+        
+        # Per-instance cache so repeated queries skip the encoder
+        self._encode_query = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self._encode_query_uncached)
+        
         self.index_dir = self.processed_data_dir / "embeddings"
         self.index_dir.mkdir(exist_ok=True)
-        self.embeddings_file = self.index_dir / "embeddings.npy"
-        self.index_file = self.index_dir / "index.bin"
-        self.metadata_file = self.index_dir / "metadata.pkl"
+        self.embeddings_file = self.index_dir / "embeddings.f16"
+        self.embeddings_meta_file = self.index_dir / "embeddings.json"
+        self.index_file = self.index_dir / "index_hnsw_sq.bin"
+        self.metadata_file = self.index_dir / "metadata.arrow"
         
         print(f"Engine ready - Dimension: {self.dim}")
 
@@ -53,104 +130,254 @@ class EmbeddingEngine:
         for ticker in COMPANIES.keys():
             file_path = self.processed_data_dir / f"{ticker}_processed.json"
             if file_path.exists():
-                with open(file_path, 'r') as f:
-                    chunks = json.load(f)
-                    all_chunks.extend(chunks)
-                    print(f"  {ticker}: {len(chunks)} chunks")
+                count = len(all_chunks)
+                with open(file_path, 'rb') as f:
+                    all_chunks.extend(ijson.items(f, 'item'))
+                print(f"  {ticker}: {len(all_chunks) - count} chunks")
         
         print(f"Total: {len(all_chunks)} chunks")
         return all_chunks
 
+    def chunk_text(self, chunk: Dict) -> str:
+        concepts = " ".join(chunk.get('financial_concepts', []))
+        section = chunk.get('section', '')
+        # No character cut: the fast tokenizer truncates to max_seq_length tokens in one pass
+        return f"{concepts} {section} {chunk['content']}"
+
+    def encode_texts(self, texts: List[str], pool=None) -> np.ndarray:
+        if pool is None:
+            return self.model.encode(texts, batch_size=GPU_BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True)
+        return self.model.encode_multi_process(texts, pool, batch_size=CPU_BATCH_SIZE, normalize_embeddings=True)
+
     def create_embeddings(self, chunks: List[Dict]) -> np.ndarray:
         print("Generating embeddings...")
+        # Normalized embeddings fit comfortably in fp16, halving RAM and disk
+        embeddings = np.empty((len(chunks), self.dim), dtype=np.float16)
         
-        texts = []
-        for chunk in chunks:
-            concepts = " ".join(chunk.get('financial_concepts', []))
-            section = chunk.get('section', '')
-            text = f"{concepts} {section} {chunk['content']}"[:512]
-            texts.append(text)
+        # On CPU, shard each batch across a pool of encoder processes
+        pool = None if self.device == "cuda" else self.model.start_multi_process_pool()
+        try:
+            for start in range(0, len(chunks), EMBED_CHUNK_SIZE):
+                texts = [self.chunk_text(chunk) for chunk in chunks[start:start + EMBED_CHUNK_SIZE]]
+                embeddings[start:start + len(texts)] = self.encode_texts(texts, pool).astype(np.float16, copy=False)
+                print(f"  {start + len(texts):,}/{len(chunks):,} chunks embedded", end="\r")
+        finally:
+            if pool is not None:
+                self.model.stop_multi_process_pool(pool)
         
-        embeddings = self.model.encode(texts, batch_size=64, show_progress_bar=True, convert_to_numpy=True)
+        print()
         return embeddings
 
     def build_index(self, embeddings: np.ndarray) -> faiss.Index:
         print("Building FAISS index...")
-        index = faiss.IndexFlatIP(self.dim)
-        faiss.normalize_L2(embeddings)
-        index.add(embeddings.astype('float32'))
+        index = faiss.IndexHNSWSQ(self.dim, faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        
+        # FAISS only accepts float32, so widen the fp16 matrix one slice at a time
+        for start in range(0, len(embeddings), INDEX_ADD_BATCH):
+            batch = np.ascontiguousarray(embeddings[start:start + INDEX_ADD_BATCH], dtype=np.float32)
+            if not index.is_trained:
+                index.train(batch)
+            index.add(batch)
         print(f"Index built: {index.ntotal} vectors")
         return index
 
     def save_index(self, embeddings: np.ndarray, chunks: List[Dict]):
-        np.save(self.embeddings_file, embeddings)
+        embeddings.astype(np.float16, copy=False).tofile(self.embeddings_file)
+        self.embeddings_meta_file.write_bytes(orjson.dumps({"shape": list(embeddings.shape), "dtype": "float16"}))
         faiss.write_index(self.index, str(self.index_file))
-        with open(self.metadata_file, 'wb') as f:
-            pickle.dump(chunks, f)
+        table = self.with_prompt_column(pa.Table.from_pylist(chunks))
+        feather.write_feather(table, self.metadata_file, compression='uncompressed')
         print(f"Index saved to {self.index_dir}")
 
+    def with_prompt_column(self, table: pa.Table) -> pa.Table:
+        """Add the truncated prompt text of every chunk as a content_prompt column"""
+        if "content_prompt" in table.column_names:
+            return table
+        prefix = pc.utf8_slice_codeunits(table["content"], 0, PROMPT_CONTENT_CHARS)
+        return table.append_column("content_prompt", pc.binary_join_element_wise(prefix, "...", ""))
+
+    def load_chunks_table(self) -> ChunkTable:
+        # Uncompressed Arrow IPC maps zero-copy, so rows are paged in only when read;
+        # tables saved before content_prompt existed get it computed once here
+        return ChunkTable(self.with_prompt_column(feather.read_table(self.metadata_file, memory_map=True)))
+
+    def load_embeddings(self) -> np.memmap:
+        meta = orjson.loads(self.embeddings_meta_file.read_bytes())
+        return np.memmap(self.embeddings_file, dtype=meta["dtype"], mode='r', shape=tuple(meta["shape"]))
+
     def load_index(self) -> bool:
-        if not all([self.embeddings_file.exists(), self.index_file.exists(), self.metadata_file.exists()]):
+        if not all([self.embeddings_file.exists(), self.embeddings_meta_file.exists(), self.metadata_file.exists()]):
             return False
         
         print("Loading existing index...")
-        self.index = faiss.read_index(str(self.index_file))
-        with open(self.metadata_file, 'rb') as f:
-            self.chunks_data = pickle.load(f)
+        self.embeddings = self.load_embeddings()
+        if self.index_file.exists():
+            self.index = faiss.read_index(str(self.index_file))
+        else:
+            # Saved embeddings are enough to rebuild the index without re-encoding
+            self.index = self.build_index(self.embeddings)
+            faiss.write_index(self.index, str(self.index_file))
+        self.chunks_data = self.load_chunks_table()
+        self.build_metadata_arrays()
         print(f"Loaded: {len(self.chunks_data)} chunks")
         return True
 
-    def score_metadata(self, chunk: Dict, query_info: Dict) -> float:
-        score = 0.1
+    def build_metadata_arrays(self):
+        table = self.chunks_data.table
+        
+        def encode(column):
+            encoded = table.column(column).combine_chunks().dictionary_encode()
+            ids = encoded.indices.to_numpy(zero_copy_only=False).astype(np.int16)
+            return ids, {value: i for i, value in enumerate(encoded.dictionary.to_pylist())}
+        
+        self.ticker_ids, self._ticker_lookup = encode('ticker')
+        self.filing_type_ids, self._filing_type_lookup = encode('filing_type')
+        self.section_ids, section_lookup = encode('section')
+        self._sections_lower = [section.lower() for section in section_lookup]
+        self._section_hits = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self._match_sections)
+        
+        # One bit per taxonomy concept, so concept overlap is an AND plus a popcount
+        concept_names = list(self.taxonomy.taxonomy)
+        if len(concept_names) > CONCEPT_MASK_BITS:
+            print(f"Warning: taxonomy has {len(concept_names)} concepts, only the first {CONCEPT_MASK_BITS} "
+                  f"count towards concept scoring; ignored: {concept_names[CONCEPT_MASK_BITS:]}")
+        self._concept_lookup = {concept: i for i, concept in enumerate(concept_names[:CONCEPT_MASK_BITS])}
+        self.concept_masks = np.zeros(len(self.chunks_data), dtype=np.uint64)
+        concepts = table.column('financial_concepts').combine_chunks()
+        rows = pc.list_parent_indices(concepts).to_numpy()
+        bits = np.array([self._concept_lookup.get(c, -1) for c in pc.list_flatten(concepts).to_pylist()], dtype=np.int64)
+        known = bits >= 0
+        np.bitwise_or.at(self.concept_masks, rows[known], np.left_shift(np.uint64(1), bits[known].astype(np.uint64)))
+
+    def _concept_mask(self, concepts: List[str]) -> np.uint64:
+        mask = 0
+        for concept in concepts:
+            if concept in self._concept_lookup:
+                mask |= 1 << self._concept_lookup[concept]
+        return np.uint64(mask)
+
+    def _match_sections(self, relevant_sections: tuple) -> np.ndarray:
+        relevant = [section.lower() for section in relevant_sections]
+        return np.array([any(r in section for r in relevant) for section in self._sections_lower])
+
+    def score_metadata(self, indices: np.ndarray, query_info: Dict) -> np.ndarray:
+        score = np.full(len(indices), 0.1)
         
-        if query_info.get('tickers') and chunk['ticker'] in query_info['tickers']:
-            score += 0.3
-        if query_info.get('filing_types') and chunk['filing_type'] in query_info['filing_types']:
-            score += 0.2
+        if query_info.get('tickers'):
+            query_ids = [self._ticker_lookup[t] for t in query_info['tickers'] if t in self._ticker_lookup]
+            score += 0.3 * np.isin(self.ticker_ids[indices], query_ids)
+        if query_info.get('filing_types'):
+            query_ids = [self._filing_type_lookup[f] for f in query_info['filing_types'] if f in self._filing_type_lookup]
+            score += 0.2 * np.isin(self.filing_type_ids[indices], query_ids)
         if query_info.get('relevant_sections'):
-            for section in query_info['relevant_sections']:
-                if section.lower() in chunk['section'].lower():
-                    score += 0.2
-                    break
+            section_hits = self._section_hits(tuple(query_info['relevant_sections']))
+            score += 0.2 * section_hits[self.section_ids[indices]]
         if query_info.get('financial_concepts'):
-            overlap = set(chunk.get('financial_concepts', [])) & set(query_info['financial_concepts'])
-            score += len(overlap) * 0.1
+            overlap = self.concept_masks[indices] & self._concept_mask(query_info['financial_concepts'])
+            score += 0.1 * np.unpackbits(overlap.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
         
-        return min(score, 1.0)
+        return np.minimum(score, 1.0)
+
+    def _encode_worker(self):
+        while True:
+            batch = [self._encode_queue.get()]
+            deadline = time.perf_counter() + QUERY_BATCH_WAIT
+            while len(batch) < QUERY_BATCH_SIZE:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._encode_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = self.model.encode([query for query, _ in batch], batch_size=QUERY_BATCH_SIZE,
+                                               convert_to_numpy=True, normalize_embeddings=True)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
 
-    def search(self, query: str, top_k: int = 10) -> List[SearchResult]:
+    def _submit_encode(self, query: str) -> Future:
+        future = Future()
+        self._encode_queue.put((query, future))
+        return future
+
+    def _encode_query_uncached(self, query_norm: str) -> bytes:
+        # Cached as normalized bytes so callers can never mutate a shared embedding
+        return self._submit_encode(query_norm).result().astype('float32').tobytes()
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """Unit-normalized float32 embedding of a query, served from the query cache"""
+        # MiniLM's tokenizer is uncased, so lowercasing only widens cache hits
+        return np.frombuffer(self._encode_query(query.strip().lower()), dtype='float32')
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Unit-normalized float32 embeddings for a batch of queries, one row per query"""
+        normalized = [query.strip().lower() for query in queries]
+        if not normalized:
+            return np.empty((0, self.dim), dtype='float32')
+        # Each distinct query goes through the query cache on its own thread: hits return at once,
+        # and the misses wait on the encode worker together, so it packs them into shared forward passes
+        distinct = list(dict.fromkeys(normalized))
+        with ThreadPoolExecutor(max_workers=min(QUERY_BATCH_SIZE, len(distinct))) as executor:
+            embeddings = dict(zip(distinct, executor.map(self._encode_query, distinct)))
+        return np.stack([np.frombuffer(embeddings[query], dtype='float32') for query in normalized])
+
+    def search(self, query: str, top_k: int = 10, query_embedding: np.ndarray = None,
+               query_info: Dict = None) -> List[SearchResult]:
+        return self.search_batch(query, top_k, query_embedding, query_info).results
+
+    def search_batch(self, query: str, top_k: int = 10, query_embedding: np.ndarray = None,
+                     query_info: Dict = None) -> SearchResultsBatch:
         if not self.index:
             raise ValueError("Index not loaded")
         
-        query_info = self.taxonomy.parse_query(query)
-        query_embedding = self.model.encode([query], convert_to_numpy=True)
-        faiss.normalize_L2(query_embedding)
+        if query_info is None:
+            query_info = self.taxonomy.parse_query(query)
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        query_embedding = np.asarray(query_embedding, dtype='float32').reshape(1, self.dim)
         
         search_k = min(top_k * 5, len(self.chunks_data))
-        similarities, indices = self.index.search(query_embedding.astype('float32'), search_k)
+        params = faiss.SearchParametersHNSW(efSearch=search_k * HNSW_EF_SEARCH_FACTOR)
+        similarities, indices = self.index.search(query_embedding, search_k, params=params)
         
+        similarities, indices = similarities[0], indices[0]
+        keep = (indices >= 0) & (similarities >= 0.1)
+        similarities, indices = similarities[keep], indices[keep]
+        
+        final_scores = 0.7 * similarities + 0.3 * self.score_metadata(indices, query_info)
+        
+        ranks = np.argsort(-final_scores, kind='stable')[:top_k]
         results = []
-        for similarity, idx in zip(similarities[0], indices[0]):
-            if similarity < 0.1:
-                continue
-                
-            chunk = self.chunks_data[idx]
-            metadata_score = self.score_metadata(chunk, query_info)
-            final_score = 0.7 * similarity + 0.3 * metadata_score
-            
+        for rank in ranks:
+            chunk = self.chunks_data[indices[rank]]
             result = SearchResult(
                 content=chunk['content'],
                 ticker=chunk['ticker'],  
                 filing_type=chunk['filing_type'],
                 section=chunk['section'],
                 chunk_id=chunk['chunk_id'],
-                financial_concepts=chunk.get('financial_concepts', []),
-                similarity_score=float(similarity),
-                final_score=final_score
+                financial_concepts=chunk.get('financial_concepts') or [],
+                similarity_score=float(similarities[rank]),
+                final_score=float(final_scores[rank]),
+                content_prompt=chunk['content_prompt']
             )
             results.append(result)
         
-        return sorted(results, key=lambda x: x.final_score, reverse=True)[:top_k]
+        return SearchResultsBatch(
+            results=results,
+            scores=final_scores[ranks].astype('float64'),
+            tickers=np.array([r.ticker for r in results], dtype=object),
+            filing_types=np.array([r.filing_type for r in results], dtype=object),
+            sections=np.array([r.section for r in results], dtype=object),
+            concepts=[frozenset(r.financial_concepts) for r in results]
+        )
 
     def initialize(self, force_rebuild: bool = False):
         if not force_rebuild and self.load_index():
@@ -163,30 +390,27 @@ class EmbeddingEngine:
         
         embeddings = self.create_embeddings(chunks)
         self.index = self.build_index(embeddings)
-        self.chunks_data = chunks
         self.save_index(embeddings, chunks)
+        self.embeddings = self.load_embeddings()
+        self.chunks_data = self.load_chunks_table()
+        self.build_metadata_arrays()
         print("Index ready!")
 
     def stats(self) -> Dict:
         if not self.chunks_data:
             return {"status": "not_initialized"}
         
-        filing_types = {}
-        sections = {}
-        concepts = {}
-        
-        for chunk in self.chunks_data:
-            filing_types[chunk['filing_type']] = filing_types.get(chunk['filing_type'], 0) + 1
-            sections[chunk['section']] = sections.get(chunk['section'], 0) + 1
-            for concept in chunk.get('financial_concepts', []):
-                concepts[concept] = concepts.get(concept, 0) + 1
+        table = self.chunks_data.table
+        filing_types = Counter(table.column('filing_type').to_pylist())
+        sections = Counter(table.column('section').to_pylist())
+        concepts = Counter(pc.list_flatten(table.column('financial_concepts')).to_pylist())
         
         return {
             "total_chunks": len(self.chunks_data),
-            "companies": len(set(chunk['ticker'] for chunk in self.chunks_data)),
-            "filing_types": dict(sorted(filing_types.items(), key=lambda x: x[1], reverse=True)[:5]),
-            "sections": dict(sorted(sections.items(), key=lambda x: x[1], reverse=True)[:3]),
-            "concepts": dict(sorted(concepts.items(), key=lambda x: x[1], reverse=True)[:5])
+            "companies": pc.count_distinct(table.column('ticker')).as_py(),
+            "filing_types": dict(filing_types.most_common(5)),
+            "sections": dict(sections.most_common(3)),
+            "concepts": dict(concepts.most_common(5))
         }
 
 
@@ -1,8 +1,20 @@
 import re
+import copy
 import json
+import functools
+import sys
+import os
+import ahocorasick
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 from pathlib import Path
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.config import COMPANIES
+
+PARSE_CACHE_SIZE = 2048
+
 class FinancialTaxonomy:
     """Financial keyword mapping for SEC filings analysis"""
     
@@ -61,7 +73,7 @@ class FinancialTaxonomy:
         }
         
         self.temporal_patterns = {
-            "year_patterns": r"\b(19|20)\d{2}\b",
+            "year_patterns": r"\b(?:19|20)\d{2}\b",
             "quarter_patterns": r"\b(Q[1-4]|first|second|third|fourth)\s+(quarter|Q)\b",
             "period_patterns": {
                 "annual": r"\b(annual|yearly|year-over-year|YoY)\b",
@@ -70,80 +82,155 @@ class FinancialTaxonomy:
                 "historical": r"\b(historical|over\s+time|trend|evolution)\b"
             }
         }
+        
+        self._parse_cached = functools.lru_cache(maxsize=PARSE_CACHE_SIZE)(self._parse_normalized)
+        self._build_indexes()
+    
+    def _build_indexes(self):
+        """Rebuild every lookup structure derived from the taxonomy and companies"""
+        self._compile_temporal_patterns()
+        
+        self._companies_items = tuple(COMPANIES.items())
+        self._companies_keys = frozenset(COMPANIES)
+        self._token_re = re.compile(r"[A-Z0-9]+")
+        
+        self._build_automaton()
+        self._build_section_keywords()
+        self._build_ticker_automaton()
+        self._parse_cached.cache_clear()
+    
+    def _build_automaton(self):
+        """Index every keyword in one Aho-Corasick automaton mapping to its concepts"""
+        concepts_by_keyword = {}
+        for concept, details in self.taxonomy.items():
+            for keyword in details["keywords"]:
+                concepts_by_keyword.setdefault(keyword.lower(), []).append(concept)
+        
+        self._automaton = ahocorasick.Automaton()
+        for keyword, concepts in concepts_by_keyword.items():
+            self._automaton.add_word(keyword, tuple(concepts))
+        self._automaton.make_automaton()
+    
+    def _compile_temporal_patterns(self):
+        """Compile the temporal regexes, with all period patterns in one alternation"""
+        self._year_re = re.compile(self.temporal_patterns["year_patterns"])
+        self._quarter_re = re.compile(self.temporal_patterns["quarter_patterns"])
+        period_patterns = self.temporal_patterns["period_patterns"]
+        self._period_re = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in period_patterns.items()))
+        self._period_priority = {name: i for i, name in enumerate(period_patterns)}
+    
+    def _build_section_keywords(self):
+        """Precompute the deduplicated keyword list for every SEC section"""
+        section_keywords = {}
+        for details in self.taxonomy.values():
+            for section in details["sec_sections"]:
+                section_keywords.setdefault(section, {}).update(dict.fromkeys(details["keywords"]))
+        self._section_keywords = {section: tuple(keywords) for section, keywords in section_keywords.items()}
+    
+    def _build_ticker_automaton(self):
+        """Index lowercased company names in one automaton"""
+        tickers_by_name = {}
+        for ticker, company_name in self._companies_items:
+            tickers_by_name.setdefault(company_name.lower(), []).append(ticker)
+        
+        self._ticker_automaton = ahocorasick.Automaton()
+        for name, tickers in tickers_by_name.items():
+            self._ticker_automaton.add_word(name, tuple(tickers))
+        self._ticker_automaton.make_automaton()
+    
+    def match_concepts(self, text_lower: str) -> List[str]:
+        """Return concepts with a keyword in lowercased text, in taxonomy order"""
+        matched = set()
+        for _, concepts in self._automaton.iter(text_lower):
+            matched.update(concepts)
+            if len(matched) == len(self.taxonomy):
+                break
+        return [concept for concept in self.taxonomy if concept in matched]
     
     def parse_query(self, query: str) -> Dict:
         """Parse query to extract concepts, tickers, time periods"""
-        query_lower = query.lower()
+        # Every extractor ignores case and padding, so such variants share one cache entry;
+        # callers get their own copy, so mutating the result never leaks into the cache
+        parsed = copy.deepcopy(self._parse_cached(query.strip().lower()))
+        parsed["original_query"] = query
+        return parsed
+    
+    def parse_queries(self, queries: List[str], max_workers: int = 1) -> List[Dict]:
+        """Parse a batch of queries, optionally fanned out across threads"""
+        # The automata are read-only and lru_cache is thread-safe, so threads can share them
+        if max_workers <= 1 or len(queries) <= 1:
+            return [self.parse_query(query) for query in queries]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+            return list(executor.map(self.parse_query, queries))
+    
+    def _parse_normalized(self, query: str) -> Dict:
+        """Parse an already stripped and lowercased query"""
+        concepts = self._map_financial_concepts(query)
+        temporal_info = self._extract_temporal_info(query)
         
         return {
             "original_query": query,
             "tickers": self._extract_tickers(query),
-            "temporal_info": self._extract_temporal_info(query),
-            "financial_concepts": self._map_financial_concepts(query_lower),
-            "relevant_sections": self._get_relevant_sections(self._map_financial_concepts(query_lower)),
-            "filing_types": self._get_filing_types(self._map_financial_concepts(query_lower), self._extract_temporal_info(query)),
-            "search_strategy": self._determine_search_strategy(self._map_financial_concepts(query_lower), self._extract_temporal_info(query))
+            "temporal_info": temporal_info,
+            "financial_concepts": concepts,
+            "relevant_sections": self._get_relevant_sections(concepts),
+            "filing_types": self._get_filing_types(concepts, temporal_info),
+            "search_strategy": self._determine_search_strategy(concepts, temporal_info)
         }
     
     def _extract_tickers(self, query: str) -> List[str]:
         """Extract ticker symbols from query"""
-        from config.config import COMPANIES
-        tickers = []
-        query_upper = query.upper()
-        
-        for ticker in COMPANIES.keys():
-            if ticker in query_upper:
-                tickers.append(ticker)
-        for ticker, company_name in COMPANIES.items():
-            if company_name.lower() in query.lower():
-                tickers.append(ticker)
-        return list(set(tickers))
+        # Tickers must appear as whole tokens, so "CAT" no longer matches inside "indicates"
+        tickers = dict.fromkeys(token for token in self._token_re.findall(query.upper()) if token in self._companies_keys)
+        for _, matched in self._ticker_automaton.iter(query.lower()):
+            tickers.update(dict.fromkeys(matched))
+        return list(tickers)
     
     def _extract_temporal_info(self, query: str) -> Dict:
         """Extract temporal information from query"""
         temporal_info = {"years": [], "quarters": [], "period_type": None}
         
-        years = re.findall(self.temporal_patterns["year_patterns"], query)
+        query_lower = query.lower()
+        years = self._year_re.findall(query)
         temporal_info["years"] = [int(year) for year in years]
         
-        quarter_matches = re.findall(self.temporal_patterns["quarter_patterns"], query.lower())
+        quarter_matches = self._quarter_re.findall(query_lower)
         temporal_info["quarters"] = quarter_matches
         
-        for period_type, pattern in self.temporal_patterns["period_patterns"].items():
-            if re.search(pattern, query.lower()):
-                temporal_info["period_type"] = period_type
-                break
+        # One scan over the query; the earliest period type in pattern order wins, wherever it appears
+        best = len(self._period_priority)
+        for match in self._period_re.finditer(query_lower):
+            priority = self._period_priority[match.lastgroup]
+            if priority < best:
+                best = priority
+                temporal_info["period_type"] = match.lastgroup
+                if best == 0:
+                    break
         return temporal_info
     
     def _map_financial_concepts(self, query_lower: str) -> List[str]:
         """Map query to financial concepts"""
-        matched_concepts = []
-        for concept, details in self.taxonomy.items():
-            for keyword in details["keywords"]:
-                if keyword.lower() in query_lower:
-                    matched_concepts.append(concept)
-                    break
-        return matched_concepts
+        return self.match_concepts(query_lower)
     
     def _get_relevant_sections(self, financial_concepts: List[str]) -> List[str]:
         """Get relevant SEC sections for financial concepts"""
-        relevant_sections = set()
+        relevant_sections = {}
         for concept in financial_concepts:
             if concept in self.taxonomy:
-                relevant_sections.update(self.taxonomy[concept]["sec_sections"])
+                relevant_sections.update(dict.fromkeys(self.taxonomy[concept]["sec_sections"]))
         return list(relevant_sections)
     
     def _get_filing_types(self, financial_concepts: List[str], temporal_info: Dict) -> List[str]:
         """Determine relevant filing types"""
-        filing_types = set()
+        filing_types = {}
         for concept in financial_concepts:
             if concept in self.taxonomy:
-                filing_types.update(self.taxonomy[concept]["filing_types"])
+                filing_types.update(dict.fromkeys(self.taxonomy[concept]["filing_types"]))
         
         if temporal_info.get("period_type") == "annual":
-            filing_types.add("10-K")
+            filing_types["10-K"] = None
         elif temporal_info.get("period_type") == "quarterly":
-            filing_types.add("10-Q")
+            filing_types["10-Q"] = None
         return list(filing_types)
     
     def _determine_search_strategy(self, financial_concepts: List[str], temporal_info: Dict) -> Dict:
@@ -161,11 +248,7 @@ class FinancialTaxonomy:
     
     def get_section_keywords(self, section_name: str) -> List[str]:
         """Get keywords associated with a specific SEC section"""
-        section_keywords = []
-        for concept, details in self.taxonomy.items():
-            if section_name in details["sec_sections"]:
-                section_keywords.extend(details["keywords"])
-        return list(set(section_keywords))
+        return list(self._section_keywords.get(section_name, ()))
     
     def save_taxonomy(self, filepath: str):
         """Save taxonomy to JSON file"""
@@ -176,12 +259,10 @@ class FinancialTaxonomy:
         """Load taxonomy from JSON file"""
         with open(filepath, 'r') as f:
             self.taxonomy = json.load(f)
+        self._build_indexes()
 
 
 if __name__ == "__main__":
-    import sys, os
-    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    
     taxonomy = FinancialTaxonomy()
     
     test_queries = [
@@ -2,22 +2,52 @@
 """SEC Filings Document Processing"""
 
 import re
-import json
+import codecs
 import time
+from bisect import bisect_left
 import sys
 import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Tuple
-from bs4 import BeautifulSoup
+from typing import Dict, List, Optional, Tuple
+import orjson
+from selectolax.lexbor import LexborHTMLParser
 from dataclasses import dataclass
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from config.config import RAW_DATA_DIR, PROCESSED_DATA_DIR, COMPANIES
+from config.config import RAW_DATA_DIR, PROCESSED_DATA_DIR, COMPANIES, MAX_WORKERS
 from financial_taxonomy import FinancialTaxonomy
 
+_TAG_RE = re.compile(r'<[^>]+>')
+_WS_RE = re.compile(r'\s+')
+_YEAR_RE = re.compile(r'(\d{4})')
+# <meta charset=...> or <meta http-equiv="Content-Type" content="...; charset=...">, near the top of a document
+_CHARSET_RE = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+_CHARSET_SNIFF_BYTES = 4096
+# Browsers read these labels as windows-1252, and SEC filings that declare them often hold cp1252 punctuation
+_CHARSET_ALIASES = {'iso8859-1': 'cp1252', 'ascii': 'cp1252'}
+
+def _declared_charset(raw: bytes) -> Optional[str]:
+    """Codec named by an HTML document's meta charset, or None when absent, unknown or UTF-8"""
+    match = _CHARSET_RE.search(raw, 0, _CHARSET_SNIFF_BYTES)
+    if not match:
+        return None
+    try:
+        codec = codecs.lookup(match.group(1).decode('ascii')).name
+    except LookupError:
+        return None
+    codec = _CHARSET_ALIASES.get(codec, codec)
+    return None if codec == 'utf-8' else codec
+
 @dataclass
 class DocumentChunk:
+    # Explicit slots (dataclass(slots=True) needs 3.10) drop the per-instance __dict__
+    __slots__ = ('content', 'ticker', 'filing_type', 'section', 'estimated_year', 'chunk_id',
+                 'financial_concepts', 'word_count')
+    
     content: str
     ticker: str
     filing_type: str
@@ -35,33 +65,55 @@ class SECDocumentProcessor:
         self.taxonomy = FinancialTaxonomy()
         
         self.section_patterns = {
-            "Risk Factors": r"(?i)item\s*1a[\.\s]*risk\s*factors",
-            "Business": r"(?i)item\s*1[\.\s]*business", 
-            "MD&A": r"(?i)item\s*7[\.\s]*management'?s\s*discussion",
-            "Financial Statements": r"(?i)item\s*8[\.\s]*financial\s*statements",
-            "Compensation": r"(?i)compensation\s*discussion",
-            "Executive Compensation": r"(?i)executive\s*compensation"
+            "Risk Factors": r"item\s*1a[\.\s]*risk\s*factors",
+            "Business": r"item\s*1[\.\s]*business", 
+            "MD&A": r"item\s*7[\.\s]*management'?s\s*discussion",
+            "Financial Statements": r"item\s*8[\.\s]*financial\s*statements",
+            "Compensation": r"compensation\s*discussion",
+            "Executive Compensation": r"executive\s*compensation"
         }
+        # All headings in one alternation, so a filing is scanned once; group s<i> is section i.
+        # Each branch sits in a lookahead, so a heading nested inside another one (e.g. "compensation
+        # discussion" within "executive compensation discussion") is still found at its own offset.
+        # The "item" headings share that literal, so it is matched once before branching.
+        self._section_names = list(self.section_patterns)
+        item_branches, branches = [], []
+        for i, pattern in enumerate(self.section_patterns.values()):
+            if pattern.startswith("item"):
+                item_branches.append(f"(?P<s{i}>{pattern[len('item'):]})")
+            else:
+                branches.append(f"(?P<s{i}>{pattern})")
+        if item_branches:
+            branches.insert(0, f"item(?:{'|'.join(item_branches)})")
+        self._section_re = re.compile(f"(?=(?:{'|'.join(branches)}))", re.IGNORECASE)
         
         print(f"Processor initialized: {self.raw_data_dir} → {self.processed_data_dir}")
 
     def extract_sections(self, content: str, filing_type: str) -> Dict[str, str]:
+        # Start offsets of every heading per section, plus where each section's first heading ends
+        starts = [[] for _ in self._section_names]
+        first_ends = {}
+        for m in self._section_re.finditer(content):
+            section_id = int(m.lastgroup[1:])
+            starts[section_id].append(m.start())
+            first_ends.setdefault(section_id, m.end(m.lastgroup))
+        
+        # A section runs from its first heading to the nearest later heading of any other section
+        section_bounds = {}
+        for section_id, start in first_ends.items():
+            end = len(content)
+            for other_id, other_starts in enumerate(starts):
+                if other_id != section_id:
+                    k = bisect_left(other_starts, start)
+                    # A heading beginning exactly at start does not end the section, as in the original search
+                    if k < len(other_starts) and start < other_starts[k] < end:
+                        end = other_starts[k]
+            section_bounds[section_id] = (start, end)
+        
         sections = {}
-        for section_name, pattern in self.section_patterns.items():
-            matches = list(re.finditer(pattern, content, re.IGNORECASE))
-            if matches:
-                start = matches[0].end()
-                end = len(content)
-                
-    
-                for other_pattern in self.section_patterns.values():
-                    if other_pattern != pattern:
-                        next_matches = list(re.finditer(other_pattern, content[start:], re.IGNORECASE))
-                        if next_matches:
-                            potential_end = start + next_matches[0].start()
-                            if start < potential_end < end:
-                                end = potential_end
-                
+        for section_id, section_name in enumerate(self._section_names):
+            if section_id in section_bounds:
+                start, end = section_bounds[section_id]
                 section_content = content[start:end].strip()
                 if len(section_content) > 200:
                     sections[section_name] = section_content
@@ -71,55 +123,58 @@ class SECDocumentProcessor:
             sections["General Content"] = content
         return sections
 
-    def clean_and_chunk(self, content: str, max_size: int = 1000) -> List[str]:
-        content = re.sub(r'<[^>]+>', '', content)  
-        content = re.sub(r'\s+', ' ', content).strip() 
-        
+    def clean_and_chunk(self, content: str, max_size: int = 1000, strip_html: bool = True) -> List[str]:
+        # Text that came out of the HTML parser has no tags left to strip
+        if strip_html:
+            content = _TAG_RE.sub('', content)
+        content = _WS_RE.sub(' ', content).strip()
         
-        words = content.split()
-        chunks, current_chunk, current_size = [], [], 0
         
-        for word in words:
-            word_len = len(word) + 1
-            if current_size + word_len > max_size and current_chunk:
-                chunks.append(' '.join(current_chunk))
-                current_chunk, current_size = [word], len(word)
+        # Slice the normalized string at spaces instead of splitting and re-joining words
+        chunks, start, length = [], 0, len(content)
+        while start < length:
+            end = start + max_size
+            if end >= length:
+                end = length
             else:
-                current_chunk.append(word)
-                current_size += word_len
-        
-        if current_chunk:
-            chunks.append(' '.join(current_chunk))
+                split = content.rfind(' ', start, end + 1)
+                # A word longer than max_size becomes its own chunk rather than being cut
+                end = split if split != -1 else content.find(' ', end)
+                if end == -1:
+                    end = length
+            chunks.append(content[start:end])
+            start = end + 1
         return chunks
 
     def tag_concepts(self, content: str) -> List[str]:
-        content_lower = content.lower()
-        concepts = []
-        for concept, details in self.taxonomy.taxonomy.items():
-            if any(keyword.lower() in content_lower for keyword in details["keywords"]):
-                concepts.append(concept)
-        return concepts
+        return self.taxonomy.match_concepts(content.lower())
 
     def process_file(self, file_path: Path, ticker: str, filing_type: str) -> List[DocumentChunk]:
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+            with open(file_path, 'rb') as f:
+                raw = f.read()
             
-            if file_path.suffix.lower() in ['.html', '.htm']:
-                content = BeautifulSoup(content, 'html.parser').get_text()
+            # lexbor reads raw bytes as UTF-8, so HTML only goes through a Python str when it declares another charset
+            is_html = file_path.suffix.lower() in ['.html', '.htm']
+            if is_html:
+                charset = _declared_charset(raw)
+                content = LexborHTMLParser(raw.decode(charset, errors='replace') if charset else raw).text(separator=' ')
+            else:
+                content = raw.decode('utf-8', errors='ignore')
+            del raw
             
             if len(content) < 200:
                 return []
             
             sections = self.extract_sections(content, filing_type)
-            year_match = re.search(r'(\d{4})', file_path.name)
+            year_match = _YEAR_RE.search(file_path.name)
             estimated_year = int(year_match.group(1)) if year_match else None
             
             chunks = []
             chunk_counter = 0
             
             for section_name, section_content in sections.items():
-                section_chunks = self.clean_and_chunk(section_content)
+                section_chunks = self.clean_and_chunk(section_content, strip_html=not is_html)
                 
                 for chunk_content in section_chunks:
                     concepts = self.tag_concepts(chunk_content)
@@ -132,7 +187,8 @@ class SECDocumentProcessor:
                         estimated_year=estimated_year,
                         chunk_id=f"{ticker}_{filing_type}_{estimated_year}_{chunk_counter}",
                         financial_concepts=concepts,
-                        word_count=len(chunk_content.split())
+                        # Chunks are single-spaced and trimmed, so words are spaces + 1
+                        word_count=chunk_content.count(' ') + 1
                     )
                     chunks.append(chunk)
                     chunk_counter += 1
@@ -142,76 +198,88 @@ class SECDocumentProcessor:
             print(f"Error processing {file_path}: {e}")
             return []
 
-    def process_company(self, ticker: str) -> List[DocumentChunk]:
+    def company_files(self, ticker: str) -> List[Tuple[Path, str, str]]:
         company_dir = self.raw_data_dir / ticker
         if not company_dir.exists():
             return []
         
-        all_chunks = []
-        print(f"Processing {ticker}")
-        
+        tasks = []
         for filing_type_dir in company_dir.iterdir():
             if not filing_type_dir.is_dir():
                 continue
             
             filing_type = filing_type_dir.name
             files = list(filing_type_dir.glob("*.html")) + list(filing_type_dir.glob("*.xml"))
-            
-            for file_path in files:
-                chunks = self.process_file(file_path, ticker, filing_type)
-                all_chunks.extend(chunks)
+            tasks.extend((file_path, ticker, filing_type) for file_path in files)
+        return tasks
+
+    def process_company(self, ticker: str) -> List[DocumentChunk]:
+        tasks = self.company_files(ticker)
+        if not tasks:
+            return []
+        
+        all_chunks = []
+        print(f"Processing {ticker}")
+        
+        for task in tasks:
+            chunks = self.process_file(*task)
+            all_chunks.extend(chunks)
         
         print(f"  Generated {len(all_chunks)} chunks")
         return all_chunks
 
     def save_data(self, chunks: List[DocumentChunk], ticker: str):
         output_file = self.processed_data_dir / f"{ticker}_processed.json"
-        chunks_data = [
-            {
-                'content': chunk.content, 'ticker': chunk.ticker, 'filing_type': chunk.filing_type,
-                'section': chunk.section, 'estimated_year': chunk.estimated_year, 'chunk_id': chunk.chunk_id,
-                'financial_concepts': chunk.financial_concepts, 'word_count': chunk.word_count
-            } for chunk in chunks
-        ]
-        
-        with open(output_file, 'w') as f:
-            json.dump(chunks_data, f, indent=2)
+        # orjson serializes DocumentChunk natively, with keys in field order. Unlike json.dump it writes
+        # non-ASCII text as raw UTF-8 rather than \u escapes; any JSON reader loads the same values
+        output_file.write_bytes(orjson.dumps(chunks, option=orjson.OPT_INDENT_2))
 
     def create_summary(self, all_chunks: List[DocumentChunk]) -> Dict:
-        summary = {
-            'total_chunks': len(all_chunks), 'companies': len(set(chunk.ticker for chunk in all_chunks)),
-            'filing_types': {}, 'sections': {}, 'financial_concepts': {}, 'years_covered': set(),
+        return {
+            'total_chunks': len(all_chunks), 'companies': len({chunk.ticker for chunk in all_chunks}),
+            'filing_types': dict(Counter(chunk.filing_type for chunk in all_chunks)),
+            'sections': dict(Counter(chunk.section for chunk in all_chunks)),
+            'financial_concepts': dict(Counter(chain.from_iterable(chunk.financial_concepts for chunk in all_chunks))),
+            'years_covered': sorted({chunk.estimated_year for chunk in all_chunks if chunk.estimated_year}),
             'total_words': sum(chunk.word_count for chunk in all_chunks)
         }
-        
-        for chunk in all_chunks:
-            summary['filing_types'][chunk.filing_type] = summary['filing_types'].get(chunk.filing_type, 0) + 1
-            summary['sections'][chunk.section] = summary['sections'].get(chunk.section, 0) + 1
-            for concept in chunk.financial_concepts:
-                summary['financial_concepts'][concept] = summary['financial_concepts'].get(concept, 0) + 1
-            if chunk.estimated_year:
-                summary['years_covered'].add(chunk.estimated_year)
-        
-        summary['years_covered'] = sorted(list(summary['years_covered']))
-        return summary
 
     def run(self, companies=None):
         start_time = time.time()
         companies_to_process = companies or list(COMPANIES.keys())
-        all_chunks = []
+        
+        # Running totals let each ticker's chunks be dropped once they are saved
+        total_chunks, total_words, tickers_seen = 0, 0, set()
+        filing_types, sections, concepts, years = Counter(), Counter(), Counter(), set()
         
         print(f"Processing {len(companies_to_process)} companies")
         print("=" * 50)
         
-        for ticker in companies_to_process:
-            chunks = self.process_company(ticker)
-            if chunks:
-                self.save_data(chunks, ticker)
-                all_chunks.extend(chunks)
+        # Files are independent, so parse them across worker processes, one ticker at a time
+        with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=_init_worker,
+                                 initargs=(self.raw_data_dir, self.processed_data_dir)) as executor:
+            for ticker, chunks in self._ticker_chunks(executor, companies_to_process):
+                print(f"{ticker}: {len(chunks)} chunks")
+                if chunks:
+                    self.save_data(chunks, ticker)
+                    total_chunks += len(chunks)
+                    tickers_seen.add(ticker)
+                    for chunk in chunks:
+                        filing_types[chunk.filing_type] += 1
+                        sections[chunk.section] += 1
+                        concepts.update(chunk.financial_concepts)
+                        total_words += chunk.word_count
+                        if chunk.estimated_year:
+                            years.add(chunk.estimated_year)
+                del chunks
         
-        summary = self.create_summary(all_chunks)
-        with open(self.processed_data_dir / 'summary.json', 'w') as f:
-            json.dump(summary, f, indent=2, default=str)
+        summary = {
+            'total_chunks': total_chunks, 'companies': len(tickers_seen),
+            'filing_types': dict(filing_types), 'sections': dict(sections),
+            'financial_concepts': dict(concepts), 'years_covered': sorted(years),
+            'total_words': total_words
+        }
+        (self.processed_data_dir / 'summary.json').write_bytes(orjson.dumps(summary, option=orjson.OPT_INDENT_2, default=str))
         
         duration = time.time() - start_time
         print("\n" + "=" * 50)
@@ -225,7 +293,30 @@ class SECDocumentProcessor:
         print(f"Top concepts: {dict(sorted(summary['financial_concepts'].items(), key=lambda x: x[1], reverse=True)[:3])}")
         print(f"Time: {duration:.1f}s")
         
-        return all_chunks
+        return summary
+
+    def _ticker_chunks(self, executor, companies):
+        """Yield (ticker, chunks) in company order, with only the next ticker's files queued on the pool"""
+        # Results are held for at most two tickers; submitting the next one first keeps the workers busy
+        pending = deque()
+        for ticker in companies:
+            pending.append((ticker, executor.map(_process_file_worker, self.company_files(ticker), chunksize=8)))
+            if len(pending) > 1:
+                ticker_done, results = pending.popleft()
+                yield ticker_done, list(chain.from_iterable(results))
+        while pending:
+            ticker_done, results = pending.popleft()
+            yield ticker_done, list(chain.from_iterable(results))
+
+
+_worker_processor = None
+
+def _init_worker(raw_data_dir, processed_data_dir):
+    global _worker_processor
+    _worker_processor = SECDocumentProcessor(raw_data_dir, processed_data_dir)
+
+def _process_file_worker(task: Tuple[Path, str, str]) -> List[DocumentChunk]:
+    return _worker_processor.process_file(*task)
 
 
 if __name__ == '__main__':
@@ -235,16 +326,11 @@ if __name__ == '__main__':
         processor = SECDocumentProcessor()
         print("Processing ALL companies in database...")
         
-        chunks = processor.run()
-        print(f"\nSuccess: Generated {len(chunks)} document chunks")
+        summary = processor.run()
+        print(f"\nSuccess: Generated {summary['total_chunks']} document chunks")
         
-        if chunks:
-            sample = chunks[0]
-            print(f"\nSample chunk:")
-            print(f"Company: {sample.ticker}")
-            print(f"Filing: {sample.filing_type} - {sample.section}")
-            print(f"Concepts: {sample.financial_concepts[:3]}")
-            print(f"Content: {sample.content[:150]}...")
+        if summary['total_chunks']:
+            print(f"Saved to: {processor.processed_data_dir}")
         else:
             print("No chunks generated - checking data availability...")
             
@@ -1,158 +1,425 @@
 
-import json
 import time
-import requests
+import atexit
+import orjson
+import httpx
 import sys
 import os
-from typing import Dict, List
-from dataclasses import dataclass
+import threading
+import asyncio
+import aiohttp
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from dataclasses import dataclass, replace
 from pathlib import Path
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from config.config import FIREWORKS_API_KEY, COMPANIES
-from financial_taxonomy import FinancialTaxonomy
-from embedding_engine import EmbeddingEngine, SearchResult
+from config.config import FIREWORKS_API_KEY, COMPANIES, CACHE_DIR, MAX_WORKERS
+from embedding_engine import EmbeddingEngine, SearchResult, SearchResultsBatch
+
+# Answers are reused for questions about the same companies and years whose embeddings are at least this similar
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 512
+SEMANTIC_CACHE_FILE = CACHE_DIR / "qa_cache.json"
+
+# Fireworks responses worth retrying, with exponential backoff between attempts
+LLM_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+LLM_RETRIES = 3
+LLM_RETRY_BACKOFF = 0.5
+# Per connect and per read, not per completion, so long streamed answers are never cut off
+LLM_TIMEOUT = 60.0  # seconds
+
+# Sent first and byte-identical on every call, so the provider can reuse its cached prefill
+SYSTEM_PROMPT = "You are a financial analyst expert. Provide accurate answers based only on SEC filing context. Always cite sources [Source X]."
+
+# Stands in for the user prompt while the request body template is serialized
+PROMPT_PLACEHOLDER = "__SEC_QA_PROMPT__"
+
+# Static prompt footer, joined once instead of on every question
+PROMPT_INSTRUCTIONS = "\n".join([
+    "Instructions:",
+    "1. Answer based only on the SEC filing content above",
+    "2. Reference sources using [Source X] notation", 
+    "3. Compare companies when multiple are mentioned",
+    "4. Be specific about metrics, dates, filing types",
+    "5. Acknowledge limitations if information is insufficient",
+    "\nAnswer:"
+])
+
+class Source(NamedTuple):
+    id: int
+    company: str
+    filing: str
+    section: str
+    score: float
 
 @dataclass
 class QAResult:
     question: str
     answer: str
-    sources: List[Dict]
+    sources: Tuple[Source, ...]
     confidence: float
     time: float
-    companies: List[str]
+    companies: Tuple[str, ...]
 
 class SECFinancialQA:
     def __init__(self):
         print("Initializing SEC QA System...")
-        self.taxonomy = FinancialTaxonomy()
         self.engine = EmbeddingEngine()
         self.engine.initialize()
+        # Share the engine's taxonomy so both sides hit one parse_query cache
+        self.taxonomy = self.engine.taxonomy
         
         self.api_key = FIREWORKS_API_KEY
         self.model = "accounts/fireworks/models/llama-v3p1-70b-instruct"
         self.api_url = "https://api.fireworks.ai/inference/v1/chat/completions"
+        
+        # HTTP/2 multiplexes concurrent evaluate() calls over one keep-alive TLS connection
+        self.headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+        transport = httpx.HTTPTransport(http2=True, retries=LLM_RETRIES,
+                                        limits=httpx.Limits(max_connections=16, max_keepalive_connections=16))
+        self.client = httpx.Client(transport=transport, headers=self.headers, timeout=LLM_TIMEOUT)
+        self._payload_templates = self._build_payload_templates()
+        
+        # normalized question -> (embedding, QAResult, scope), oldest first; the matrix is rebuilt only when entries change
+        self._semantic_cache = OrderedDict()
+        self._cache_keys, self._cache_scopes, self._cache_matrix = [], [], None
+        self._cache_lock = threading.Lock()
+        self.load_cache()
+        atexit.register(self.save_cache)
         print("System ready")
 
-    def call_llm(self, prompt: str) -> str:
-        headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
-        payload = {
-            "model": self.model,
-            "messages": [
-                {"role": "system", "content": "You are a financial analyst expert. Provide accurate answers based only on SEC filing context. Always cite sources [Source X]."},
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 1500,
-            "temperature": 0.1
-        }
-        
+    def _index_fingerprint(self) -> List:
+        """Size and mtime of the index files, so answers cached against another index are dropped"""
+        return [[path.name, path.stat().st_size, path.stat().st_mtime_ns]
+                for path in (self.engine.embeddings_file, self.engine.metadata_file)]
+
+    @staticmethod
+    def _query_scope(query_info: Dict) -> Tuple[tuple, tuple]:
+        """Companies and years a question asks about; a semantic hit must match both"""
+        return (tuple(sorted(query_info.get('tickers', []))),
+                tuple(sorted(query_info.get('temporal_info', {}).get('years', []))))
+
+    def load_cache(self, path: Path = SEMANTIC_CACHE_FILE):
+        if not path.exists():
+            return
+        try:
+            data = orjson.loads(path.read_bytes())
+            if data.get("index") != self._index_fingerprint():
+                print("Answer cache was built against another index, discarding it")
+                return
+            for entry in data["entries"][-SEMANTIC_CACHE_SIZE:]:
+                result = QAResult(entry["question"], entry["answer"], tuple(Source(*source) for source in entry["sources"]),
+                                  entry["confidence"], entry["time"], tuple(entry["companies"]))
+                scope = (tuple(entry["tickers"]), tuple(entry["years"]))
+                embedding = np.asarray(entry["embedding"], dtype=np.float32)
+                self._semantic_cache[result.question.strip().lower()] = (embedding, result, scope)
+            self._cache_matrix = None
+            print(f"Loaded {len(self._semantic_cache)} cached answers")
+        except Exception as e:
+            print(f"Could not load answer cache: {e}")
+
+    def save_cache(self, path: Path = SEMANTIC_CACHE_FILE):
+        if not self._semantic_cache:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with self._cache_lock:
+                entries = [
+                    {"question": result.question, "embedding": embedding, "tickers": list(tickers), "years": list(years),
+                     "answer": result.answer, "sources": [list(source) for source in result.sources],
+                     "confidence": result.confidence, "time": result.time, "companies": result.companies}
+                    for embedding, result, (tickers, years) in self._semantic_cache.values()
+                ]
+            data = {"index": self._index_fingerprint(), "entries": entries}
+            path.write_bytes(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY))
+        except Exception as e:
+            print(f"Could not save answer cache: {e}")
+
+    def _cache_get(self, question: str) -> Optional[QAResult]:
+        """Exact tier: a re-submitted question is a dict hit with no parsing or similarity scan"""
+        with self._cache_lock:
+            key = question.strip().lower()
+            if key not in self._semantic_cache:
+                return None
+            self._semantic_cache.move_to_end(key)
+            return self._semantic_cache[key][1]
+
+    def _cache_match(self, embedding: np.ndarray, query_info: Dict) -> Optional[QAResult]:
+        """Semantic tier: the most similar cached question asking about the same companies and years"""
+        scope = self._query_scope(query_info)
+        with self._cache_lock:
+            if not self._semantic_cache:
+                return None
+            if self._cache_matrix is None:
+                self._cache_keys = list(self._semantic_cache)
+                self._cache_scopes = [self._semantic_cache[key][2] for key in self._cache_keys]
+                self._cache_matrix = np.stack([self._semantic_cache[key][0] for key in self._cache_keys])
+            
+            # Near-identical wording can still differ in year or company, which changes the answer
+            candidates = [i for i, entry_scope in enumerate(self._cache_scopes) if entry_scope == scope]
+            if not candidates:
+                return None
+            
+            # Embeddings are unit-normalized, so the dot product is the cosine similarity
+            similarities = self._cache_matrix[candidates] @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+                return None
+            key = self._cache_keys[candidates[best]]
+            self._semantic_cache.move_to_end(key)
+            return self._semantic_cache[key][1]
+
+    def _cache_store(self, question: str, embedding: np.ndarray, result: QAResult, query_info: Dict):
+        with self._cache_lock:
+            key = question.strip().lower()
+            self._semantic_cache[key] = (embedding, result, self._query_scope(query_info))
+            self._semantic_cache.move_to_end(key)
+            while len(self._semantic_cache) > SEMANTIC_CACHE_SIZE:
+                self._semantic_cache.popitem(last=False)
+            self._cache_matrix = None
+
+    def _build_payload_templates(self) -> Dict[bool, tuple]:
+        """Serialize the constant request body once per stream mode, split around the prompt"""
+        templates = {}
+        for stream in (False, True):
+            payload = {
+                "model": self.model,
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": PROMPT_PLACEHOLDER}
+                ],
+                "max_tokens": 1500,
+                "temperature": 0.1
+            }
+            if stream:
+                payload["stream"] = True
+            prefix, suffix = orjson.dumps(payload).split(orjson.dumps(PROMPT_PLACEHOLDER))
+            templates[stream] = (prefix, suffix)
+        return templates
+
+    def _llm_payload(self, prompt: str, stream: bool) -> bytes:
+        # Only the prompt is encoded per call; the shared templates are never mutated, so threads can reuse them
+        prefix, suffix = self._payload_templates[stream]
+        return prefix + orjson.dumps(prompt) + suffix
+
+    def call_llm(self, prompt: str, stream: bool = True, on_token: Optional[Callable[[str], None]] = None) -> str:
+        payload = self._llm_payload(prompt, stream)
+        try:
+            for attempt in range(LLM_RETRIES + 1):
+                with self.client.stream("POST", self.api_url, content=payload) as response:
+                    if response.status_code in LLM_RETRY_STATUSES and attempt < LLM_RETRIES:
+                        time.sleep(LLM_RETRY_BACKOFF * 2 ** attempt)
+                        continue
+                    response.raise_for_status()
+                    # Fall back to the plain JSON body if streaming is off or the server ignored it
+                    if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                        return orjson.loads(response.read())["choices"][0]["message"]["content"]
+                    return self._read_stream(response, on_token)
+        except Exception as e:
+            return f"Error: {e}"
+
+    async def acall_llm(self, session: aiohttp.ClientSession, prompt: str, stream: bool = True) -> str:
+        """call_llm on an aiohttp session, for answering many questions on one event loop"""
+        payload = self._llm_payload(prompt, stream)
         try:
-            response = requests.post(self.api_url, headers=headers, json=payload, timeout=60)
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
+            for attempt in range(LLM_RETRIES + 1):
+                async with session.post(self.api_url, data=payload) as response:
+                    if response.status in LLM_RETRY_STATUSES and attempt < LLM_RETRIES:
+                        await asyncio.sleep(LLM_RETRY_BACKOFF * 2 ** attempt)
+                        continue
+                    response.raise_for_status()
+                    if not response.content_type.startswith("text/event-stream"):
+                        return orjson.loads(await response.read())["choices"][0]["message"]["content"]
+                    parts = []
+                    async for line in response.content:
+                        token = self._event_token(line.decode())
+                        if token:
+                            parts.append(token)
+                    return "".join(parts)
         except Exception as e:
             return f"Error: {e}"
 
+    def _event_token(self, line: str) -> Optional[str]:
+        """Content delta carried by one server-sent-events line, if any"""
+        line = line.strip()
+        if not line.startswith("data:"):
+            return None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        choices = orjson.loads(data).get("choices")
+        if not choices:
+            return None
+        return (choices[0].get("delta") or {}).get("content")
+
+    def _read_stream(self, response: httpx.Response, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """Join the content deltas of a server-sent-events completion as they arrive"""
+        parts = []
+        for line in response.iter_lines():
+            token = self._event_token(line)
+            if token:
+                parts.append(token)
+                if on_token:
+                    on_token(token)
+        return "".join(parts)
+
     def create_prompt(self, question: str, results: List[SearchResult]) -> str:
-        context = [f"Question: {question}\n\nSEC Filing Context:"]
-        
-        for i, result in enumerate(results[:8], 1):
-            company = COMPANIES.get(result.ticker, result.ticker)
-            context.append(f"[Source {i}] {company} ({result.ticker}) - {result.filing_type} - {result.section}")
-            context.append(f"{result.content[:600]}...")
-            context.append("")
-        
-        context.extend([
-            "Instructions:",
-            "1. Answer based only on the SEC filing content above",
-            "2. Reference sources using [Source X] notation", 
-            "3. Compare companies when multiple are mentioned",
-            "4. Be specific about metrics, dates, filing types",
-            "5. Acknowledge limitations if information is insufficient",
-            "\nAnswer:"
-        ])
-        
-        return "\n".join(context)
-
-    def calculate_confidence(self, results: List[SearchResult], query_info: Dict) -> float:
-        if not results:
+        company_name = COMPANIES.get
+        context = "".join(
+            f"[Source {i}] {company_name(r.ticker, r.ticker)} ({r.ticker}) - {r.filing_type} - {r.section}\n{r.content_prompt}\n\n"
+            for i, r in enumerate(results[:8], 1)
+        )
+        return f"Question: {question}\n\nSEC Filing Context:\n{context}{PROMPT_INSTRUCTIONS}"
+
+    def calculate_confidence(self, batch: SearchResultsBatch, query_info: Dict) -> float:
+        if not batch.results:
             return 0.0
         
         # Base score from search results
-        base_score = sum(r.final_score for r in results) / len(results)
+        base_score = float(batch.scores.mean())
         
         # Boost for ticker matches
         ticker_boost = 0.1
         if query_info.get('tickers'):
-            matches = sum(1 for r in results if r.ticker in query_info['tickers'])
-            ticker_boost = (matches / len(results)) * 0.2
+            ticker_boost = float(np.isin(batch.tickers, query_info['tickers']).mean()) * 0.2
         
         # Boost for concept matches
-        concept_boost = 0
-        for result in results:
-            if any(c in result.financial_concepts for c in query_info.get('financial_concepts', [])):
-                concept_boost += 0.02
+        query_concepts = set(query_info.get('financial_concepts', []))
+        concept_boost = 0.02 * sum(1 for concepts in batch.concepts if concepts & query_concepts)
         
         # Boost for company diversity
-        diversity = len(set(r.ticker for r in results)) * 0.03
+        diversity = np.unique(batch.tickers).size * 0.03
         
         return min(base_score + ticker_boost + concept_boost + diversity, 1.0)
 
     def answer(self, question: str) -> QAResult:
-        start_time = time.time()
+        start_time = time.perf_counter()
+        # A repeated question is answered before it is even embedded
+        cached = self._cache_get(question)
+        if cached is not None:
+            return replace(cached, question=question, time=time.perf_counter() - start_time)
+        question_embedding = self.engine.embed_query(question)
+        return self.answer_prepared(question, question_embedding, start_time=start_time)
+
+    def answer_prepared(self, question: str, question_embedding: np.ndarray, query_info: Optional[Dict] = None,
+                        start_time: Optional[float] = None) -> QAResult:
+        """Answer a question whose embedding (and optionally parsed query) was computed ahead of time"""
+        start_time = time.perf_counter() if start_time is None else start_time
+        
+        # A hit returns the stored result as is: no search, LLM call or confidence scoring
+        cached = self._cache_get(question)
+        if cached is None:
+            if query_info is None:
+                query_info = self.taxonomy.parse_query(question)
+            cached = self._cache_match(question_embedding, query_info)
+        if cached is not None:
+            return replace(cached, question=question, time=time.perf_counter() - start_time)
         
-        # Parse and search
-        query_info = self.taxonomy.parse_query(question)
-        results = self.engine.search(question, top_k=12)
+        # Search with the precomputed embedding
+        batch = self.engine.search_batch(question, top_k=12, query_embedding=question_embedding, query_info=query_info)
+        results = batch.results
         
         if not results:
-            return QAResult(question, "No relevant SEC filing information found.", [], 0.0, time.time() - start_time, [])
+            return QAResult(question, "No relevant SEC filing information found.", (), 0.0, time.perf_counter() - start_time, ())
         
         # Generate answer
         prompt = self.create_prompt(question, results)
         answer = self.call_llm(prompt)
+        return self._finish_answer(question, question_embedding, query_info, batch, answer, start_time)
+
+    async def aanswer_prepared(self, session: aiohttp.ClientSession, question: str, question_embedding: np.ndarray,
+                               query_info: Optional[Dict] = None, start_time: Optional[float] = None) -> QAResult:
+        """answer_prepared with the LLM call awaited on an aiohttp session"""
+        start_time = time.perf_counter() if start_time is None else start_time
         
-        # Extract metadata
-        sources = []
-        for i, r in enumerate(results, 1):
-            sources.append({
-                "id": i,
-                "company": f"{COMPANIES.get(r.ticker, r.ticker)} ({r.ticker})",
-                "filing": r.filing_type,
-                "section": r.section,
-                "score": round(r.final_score, 3)
-            })
+        cached = self._cache_get(question)
+        if cached is None:
+            if query_info is None:
+                query_info = self.taxonomy.parse_query(question)
+            cached = self._cache_match(question_embedding, query_info)
+        if cached is not None:
+            return replace(cached, question=question, time=time.perf_counter() - start_time)
         
-        confidence = self.calculate_confidence(results, query_info)
-        companies = list(set(r.ticker for r in results))
-        processing_time = time.time() - start_time
+        # Search runs in a worker thread so it never blocks the other questions' requests
+        loop = asyncio.get_running_loop()
+        batch = await loop.run_in_executor(None, self.engine.search_batch, question, 12, question_embedding, query_info)
+        if not batch.results:
+            return QAResult(question, "No relevant SEC filing information found.", (), 0.0, time.perf_counter() - start_time, ())
         
-        return QAResult(question, answer, sources, confidence, processing_time, companies)
+        answer = await self.acall_llm(session, self.create_prompt(question, batch.results))
+        return self._finish_answer(question, question_embedding, query_info, batch, answer, start_time)
 
-    def evaluate(self, questions: List[str]) -> List[QAResult]:
+    def _finish_answer(self, question: str, question_embedding: np.ndarray, query_info: Dict,
+                       batch: SearchResultsBatch, answer: str, start_time: float) -> QAResult:
+        tickers = batch.tickers.tolist()
+        
+        # Extract metadata from the result columns
+        company_name = COMPANIES.get
+        sources = tuple(
+            Source(i, f"{company_name(ticker, ticker)} ({ticker})", filing_type, section, round(score, 3))
+            for i, (ticker, filing_type, section, score)
+            in enumerate(zip(tickers, batch.filing_types.tolist(), batch.sections.tolist(), batch.scores.tolist()), 1)
+        )
+        
+        confidence = self.calculate_confidence(batch, query_info)
+        companies = tuple(dict.fromkeys(tickers))
+        processing_time = time.perf_counter() - start_time
+        
+        result = QAResult(question, answer, sources, confidence, processing_time, companies)
+        if not answer.startswith("Error:"):
+            self._cache_store(question, question_embedding, result, query_info)
+        return result
+
+    def evaluate(self, questions: List[str], max_workers: int = MAX_WORKERS) -> List[QAResult]:
         print(f"Evaluating {len(questions)} questions...")
-        results = []
+        results = [None] * len(questions)
         
-        for i, q in enumerate(questions, 1):
-            print(f"[{i}/{len(questions)}] {q[:50]}...")
-            result = self.answer(q)
-            results.append(result)
-            print(f"  Confidence: {result.confidence:.3f}, Time: {result.time:.1f}s")
+        # Embed every question in batched forward passes up front instead of one per answer
+        embeddings = self.engine.embed_queries(questions)
+        
+        # Each answer mostly waits on the LLM, so questions run concurrently; results keep input order
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(questions)))) as executor:
+            futures = {executor.submit(self.answer_prepared, q, embeddings[i]): i for i, q in enumerate(questions)}
+            for done, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                result = results[i] = future.result()
+                print(f"[{done}/{len(questions)}] {questions[i][:50]}...")
+                print(f"  Confidence: {result.confidence:.3f}, Time: {result.time:.1f}s")
         
         return results
 
+    async def evaluate_async(self, questions: List[str]) -> List[QAResult]:
+        """evaluate() on one event loop: all LLM calls share a single aiohttp connection pool"""
+        print(f"Evaluating {len(questions)} questions...")
+        embeddings = await asyncio.get_running_loop().run_in_executor(None, self.engine.embed_queries, questions)
+        
+        connector = aiohttp.TCPConnector(limit=16, keepalive_timeout=60)
+        # Like httpx's timeout on the sync path: no cap on the whole completion, only on each connect and read
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=LLM_TIMEOUT, sock_read=LLM_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers) as session:
+            results = await asyncio.gather(*[
+                self.aanswer_prepared(session, q, embeddings[i]) for i, q in enumerate(questions)
+            ])
+        
+        for i, result in enumerate(results, 1):
+            print(f"[{i}/{len(questions)}] {result.question[:50]}...")
+            print(f"  Confidence: {result.confidence:.3f}, Time: {result.time:.1f}s")
+        return list(results)
+
     def print_result(self, result: QAResult):
         print("=" * 60)
         print(f"Q: {result.question}")
         print(f"\nA: {result.answer}")
         print(f"\nMetadata: Confidence {result.confidence:.3f}, {result.time:.1f}s, {len(result.companies)} companies")
-        print(f"Sources: {', '.join([f'{s["company"]}-{s["filing"]}' for s in result.sources[:3]])}")
+        print(f"Sources: {', '.join(f'{s.company}-{s.filing}' for s in result.sources[:3])}")
 
 
-def main():
-    qa = SECFinancialQA()
-    
+def run_full_evaluation(qa: SECFinancialQA, use_async: bool = False) -> List[QAResult]:
+    """Run the evaluation question set against an initialized QA system, on threads or one event loop"""
     # Diverse evaluation questions targeting different filing types
     questions = [
         # 10-K: Annual comprehensive business overview
@@ -193,7 +460,7 @@ def main():
     print("Filing types: 10-K, 10-Q, 8-K, DEF 14A, Form 4\n")
     
     # Run evaluation
-    results = qa.evaluate(questions)
+    results = asyncio.run(qa.evaluate_async(questions)) if use_async else qa.evaluate(questions)
     
     # Print results
     for result in results:
@@ -213,12 +480,17 @@ def main():
     
     # Save results
     output = Path("qa_results.json")
-    with open(output, 'w') as f:
-        data = [{"q": r.question, "a": r.answer, "conf": float(r.confidence), "time": float(r.time)} for r in results]
-        json.dump(data, f, indent=2)
+    data = [{"q": r.question, "a": r.answer, "conf": float(r.confidence), "time": float(r.time)} for r in results]
+    output.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     
     print(f"Results saved: {output}")
     print("Evaluation complete!")
+    return results
+
+
+def main():
+    qa = SECFinancialQA()
+    run_full_evaluation(qa, use_async=os.getenv("SEC_QA_ASYNC", "0") == "1")
 
 
 if __name__ == '__main__':
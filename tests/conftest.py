@@ -0,0 +1,9 @@
+import os
+import sys
+
+# config.config refuses to import without an API key; tests never call the LLM
+os.environ.setdefault("FIREWORKS_API_KEY", "test")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "src"))
@@ -0,0 +1,76 @@
+import http.server
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("requests_cache")
+_sec_gateway = pytest.importorskip("sec_edgar_downloader._sec_gateway")
+
+import data_acquisition
+from data_acquisition import SECDownloader
+
+
+@pytest.fixture
+def sec_server():
+    paths = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            paths.append(self.path)
+            if self.path == "/company_tickers_exchange.json":
+                body = b'{"fields": ["cik", "name", "ticker", "exchange"], "data": [[320193, "Apple Inc.", "AAPL", "Nasdaq"]]}'
+            else:
+                body = b'{"filings": []}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", paths
+    server.shutdown()
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch, sec_server):
+    # Restore the library's module state after the test patches it
+    monkeypatch.setattr(_sec_gateway, "_call_sec", _sec_gateway._call_sec)
+    monkeypatch.setattr(_sec_gateway, "requests", _sec_gateway.requests)
+    monkeypatch.setattr(_sec_gateway, "URL_CIK_MAPPING", f"{sec_server[0]}/company_tickers_exchange.json")
+    monkeypatch.setattr(data_acquisition, "CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setenv("SEC_ENABLE_HTTP_CACHE", "1")
+    return SECDownloader(tmp_path / "raw")
+
+
+def test_cached_sec_responses_skip_the_rate_limiter(downloader, sec_server):
+    base_url, paths = sec_server
+    uris = [f"{base_url}/submissions/{i}.json" for i in range(15)]
+    for uri in uris:
+        _sec_gateway.get_list_of_available_filings(uri, "test@example.com")
+    assert len(paths) == len(uris) + 1
+
+    # Way past the library's 10 requests/second, none of them reaching the network
+    start = time.perf_counter()
+    for _ in range(5):
+        for uri in uris:
+            assert _sec_gateway.get_list_of_available_filings(uri, "test@example.com") == {"filings": []}
+    assert time.perf_counter() - start < 1.0
+    assert len(paths) == len(uris) + 1
+
+
+def test_ticker_mapping_is_served_from_the_cache(downloader, sec_server, tmp_path):
+    _, paths = sec_server
+    assert SECDownloader(tmp_path / "raw").downloader.ticker_to_cik_mapping == {"AAPL": "0000320193"}
+    assert paths == ["/company_tickers_exchange.json"]
+
+
+def test_second_downloader_wraps_the_library_call_once(downloader, tmp_path):
+    limited_call_sec = _sec_gateway._call_sec._limited_call_sec
+    SECDownloader(tmp_path / "raw")
+    assert _sec_gateway._call_sec._limited_call_sec is limited_call_sec
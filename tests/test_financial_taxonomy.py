@@ -0,0 +1,41 @@
+from financial_taxonomy import FinancialTaxonomy
+
+
+def test_parse_query_results_do_not_share_cached_state():
+    taxonomy = FinancialTaxonomy()
+    query = "AAPL revenue growth in 2022 annual report"
+
+    first = taxonomy.parse_query(query)
+    first["tickers"].append("MSFT")
+    first["temporal_info"]["years"].clear()
+    first["search_strategy"]["filters"]["years"].append(1999)
+
+    second = taxonomy.parse_query(query)
+    assert second["tickers"] == ["AAPL"]
+    assert second["temporal_info"]["years"] == [2022]
+    assert second["search_strategy"]["filters"]["years"] == [2022]
+
+
+def test_parse_queries_matches_parse_query_in_order_with_independent_results():
+    taxonomy = FinancialTaxonomy()
+    queries = [
+        "AAPL revenue growth in 2022 annual report",
+        "MSFT research and development spending",
+        "  aapl REVENUE growth in 2022 annual report  ",
+        "JPM climate risk factors in 2021",
+        "AAPL revenue growth in 2022 annual report",
+    ]
+
+    parsed = taxonomy.parse_queries(queries, max_workers=4)
+    assert parsed == [taxonomy.parse_query(query) for query in queries]
+    assert [result["original_query"] for result in parsed] == queries
+
+    # Repeated and case-variant queries share a cache entry, yet each result is its own copy
+    parsed[0]["tickers"].append("MSFT")
+    parsed[0]["temporal_info"]["years"].clear()
+    parsed[0]["search_strategy"]["filters"]["years"].append(1999)
+    for result in parsed[2:5:2]:
+        assert result["tickers"] == ["AAPL"]
+        assert result["temporal_info"]["years"] == [2022]
+        assert result["search_strategy"]["filters"]["years"] == [2022]
+    assert taxonomy.parse_query(queries[0])["tickers"] == ["AAPL"]
@@ -0,0 +1,79 @@
+import random
+import re
+
+import pytest
+
+from preprocessing import SECDocumentProcessor
+
+
+@pytest.fixture
+def processor(tmp_path):
+    return SECDocumentProcessor(tmp_path / "raw", tmp_path / "processed")
+
+
+def reference_sections(section_patterns, content):
+    """The original one-pattern-at-a-time section extraction"""
+    sections = {}
+    for section_name, pattern in section_patterns.items():
+        matches = list(re.finditer(pattern, content, re.IGNORECASE))
+        if matches:
+            start = matches[0].end()
+            end = len(content)
+            for other_pattern in section_patterns.values():
+                if other_pattern != pattern:
+                    next_matches = list(re.finditer(other_pattern, content[start:], re.IGNORECASE))
+                    if next_matches:
+                        potential_end = start + next_matches[0].start()
+                        if start < potential_end < end:
+                            end = potential_end
+            section_content = content[start:end].strip()
+            if len(section_content) > 200:
+                sections[section_name] = section_content
+    if not sections and len(content) > 200:
+        sections["General Content"] = content
+    return sections
+
+
+HEADINGS = [
+    "Item 1A. Risk Factors", "ITEM 1 Business", "Item 7. Management's Discussion",
+    "item 8 financial statements", "Compensation Discussion", "Executive Compensation",
+    "Executive compensation discussion and analysis", "item 1a item 1 business",
+    "executive executive compensation", "compensation compensation discussion",
+]
+FILLER = "revenue grew in the period while costs and margins held steady".split()
+
+
+def test_nested_compensation_headings_keep_both_sections(processor):
+    body = " ".join(FILLER * 10)
+    content = f"Executive compensation discussion and analysis {body} Item 7. Management's discussion {body}"
+
+    sections = processor.extract_sections(content, "DEF 14A")
+
+    assert set(sections) == {"Compensation", "Executive Compensation", "MD&A"}
+    assert sections == reference_sections(processor.section_patterns, content)
+
+
+def test_extract_sections_matches_reference_on_random_layouts(processor):
+    rng = random.Random(0)
+    for _ in range(2000):
+        parts = []
+        for _ in range(rng.randint(0, 8)):
+            parts.append(rng.choice(HEADINGS) if rng.random() < 0.3 else " ".join(rng.choices(FILLER, k=rng.randint(0, 60))))
+        content = " ".join(parts)
+        assert processor.extract_sections(content, "10-K") == reference_sections(processor.section_patterns, content)
+
+
+@pytest.mark.parametrize("meta", [
+    b'<meta http-equiv="Content-Type" content="text/html; charset=windows-1252">',
+    b'<meta charset="iso-8859-1">',
+])
+def test_process_file_decodes_declared_cp1252(processor, tmp_path, meta):
+    body = b" ".join([b"The Company\x92s net sales rose \x96 driven by services."] * 10)
+    path = tmp_path / "0000320193-22-000108_aapl.htm"
+    path.write_bytes(b"<html><head>" + meta + b"</head><body><p>" + body + b"</p></body></html>")
+
+    chunks = processor.process_file(path, "AAPL", "10-K")
+
+    content = " ".join(chunk.content for chunk in chunks)
+    assert "Company’s net sales rose – driven" in content
+    assert "�" not in content
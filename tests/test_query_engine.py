@@ -0,0 +1,120 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")
+from aiohttp import web
+
+import query_engine
+from embedding_engine import SearchResult, SearchResultsBatch
+from financial_taxonomy import FinancialTaxonomy
+from query_engine import SECFinancialQA
+
+
+class FakeEngine:
+    """Search over one fixed chunk, with a distinct unit embedding per question"""
+
+    def __init__(self):
+        self.taxonomy = FinancialTaxonomy()
+
+    def initialize(self):
+        pass
+
+    def embed_query(self, query):
+        return self.embed_queries([query])[0]
+
+    def embed_queries(self, queries):
+        return np.eye(len(queries), 8, dtype=np.float32)
+
+    def search_batch(self, query, top_k=10, query_embedding=None, query_info=None):
+        result = SearchResult(content="Revenue grew.", ticker="AAPL", filing_type="10-K", section="MD&A",
+                              chunk_id="AAPL_0", financial_concepts=["revenue_performance"],
+                              similarity_score=0.8, final_score=0.8, content_prompt="Revenue grew.")
+        return SearchResultsBatch(results=[result], scores=np.array([0.8]), tickers=np.array(["AAPL"], dtype=object),
+                                  filing_types=np.array(["10-K"], dtype=object), sections=np.array(["MD&A"], dtype=object),
+                                  concepts=[frozenset(result.financial_concepts)])
+
+
+@pytest.fixture
+def qa(monkeypatch):
+    monkeypatch.setattr(query_engine, "EmbeddingEngine", FakeEngine)
+    monkeypatch.setattr(query_engine, "LLM_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(SECFinancialQA, "load_cache", lambda self, path=None: None)
+    monkeypatch.setattr(SECFinancialQA, "save_cache", lambda self, path=None: None)
+    return SECFinancialQA()
+
+
+def evaluate_against(qa, completions, questions):
+    """Run evaluate_async with the LLM endpoint served by a local aiohttp handler"""
+    async def run():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", completions)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        qa.api_url = f"http://127.0.0.1:{runner.addresses[0][1]}/v1/chat/completions"
+        try:
+            return await qa.evaluate_async(questions)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_evaluate_async_retries_unavailable_llm(qa):
+    requests = []
+
+    async def completions(request):
+        requests.append(await request.json())
+        if len(requests) == 1:
+            return web.Response(status=503)
+        return web.json_response({"choices": [{"message": {"content": "Revenue grew [Source 1]"}}]})
+
+    results = evaluate_against(qa, completions, ["What drives AAPL revenue?", "How did AAPL margins change?"])
+
+    assert [r.answer for r in results] == ["Revenue grew [Source 1]"] * 2
+    assert [r.question for r in results] == ["What drives AAPL revenue?", "How did AAPL margins change?"]
+    assert len(requests) == 3
+    assert results[0].sources[0].company.endswith("(AAPL)")
+
+
+def test_evaluate_async_streams_past_the_timeout_while_chunks_keep_arriving(qa, monkeypatch):
+    monkeypatch.setattr(query_engine, "LLM_TIMEOUT", 0.3)
+    requests = []
+
+    async def completions(request):
+        requests.append(await request.json())
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        # 0.8s in total, but never more than 0.1s between chunks
+        for token in ["Revenue", " grew", " in", " every", " segment", " [Source", " 1]", ""]:
+            await asyncio.sleep(0.1)
+            await response.write(b'data: {"choices": [{"delta": {"content": "%s"}}]}\n\n' % token.encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    results = evaluate_against(qa, completions, ["What drives AAPL revenue?"])
+
+    assert results[0].answer == "Revenue grew in every segment [Source 1]"
+    assert len(requests) == 1
+
+
+def test_cache_hits_do_not_share_state_with_the_cache(qa, monkeypatch):
+    monkeypatch.setattr(qa, "call_llm", lambda prompt, stream=True, on_token=None: "Revenue grew [Source 1]")
+    question = "What drives AAPL revenue?"
+    qa.answer(question)
+
+    hit = qa.answer(question)
+    assert hit.companies == ("AAPL",)
+    with pytest.raises(AttributeError):
+        hit.companies.append("MSFT")
+    hit.companies += ("MSFT",)
+    hit.answer = "edited"
+
+    again = qa.answer(question)
+    assert again.companies == ("AAPL",)
+    assert again.answer == "Revenue grew [Source 1]"
+    assert qa._cache_get(question).companies == ("AAPL",)